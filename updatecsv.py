@@ -1,9 +1,19 @@
-import csv, json, logging, time, random, string, subprocess
+import csv, json, logging, time, random, string, subprocess, threading, hashlib, io
 import routeros_api
-from collections import OrderedDict
-import os, re, argparse, gc, psutil, sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+import os, re, argparse, gc, sys
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        _json_loads = ujson.loads
+    except ImportError:
+        _json_loads = json.loads
 
-CSV_FILE_PATH = 'ShapedDevices.csv'
 CONFIG_JSON = 'config.json'
 SHAPED_DEVICES_CSV = 'ShapedDevices.csv'
 NETWORK_JSON = 'network.json'
@@ -16,8 +26,14 @@ FIELDNAMES = [
     'Download Max Mbps', 'Upload Max Mbps', 'Comment'
 ]
 
+_ROW_TEMPLATE = {name: '' for name in FIELDNAMES}
+_ROW_TEMPLATE['_last_seen'] = 0
+
+_RATE_RE = re.compile(r'(\d+(?:\.\d+)?)([kmgKMG])?')
+
 DEFAULT_SCAN_INTERVAL = 600
 ERROR_RETRY_INTERVAL = 30
+CONNECT_ATTEMPTS = 3
 MIN_RATE_PERCENTAGE = 0.3
 MAX_RATE_PERCENTAGE = 1.3
 ID_LENGTH = 8
@@ -32,56 +48,124 @@ args = parser.parse_args()
 start_time = time.time()
 cycle_count = 0
 
+MAX_SCAN_WORKERS = 32
+
+shaped_lock = threading.Lock()
+rotate_lock = threading.Lock()
+rotate_state = {"index": 0}
+
 logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
+_ID_ALPHABET = string.digits + string.ascii_uppercase
+
 def generate_short_id(length=ID_LENGTH):
-    return ''.join(random.choices(string.digits + string.ascii_uppercase, k=length))
+    return ''.join(_ID_ALPHABET[b % len(_ID_ALPHABET)] for b in os.urandom(length))
+
+_json_cache = {}
 
 def read_json_data(file_path):
-    if os.path.exists(file_path):
-        with open(file_path, 'r') as json_file:
-            return json.load(json_file)
-    return {}
+    if not os.path.exists(file_path):
+        return {}
+    mtime = os.stat(file_path).st_mtime_ns
+    cached = _json_cache.get(file_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(file_path, 'rb') as json_file:
+        data = _json_loads(json_file.read())
+    _json_cache[file_path] = (mtime, data)
+    return data
 
 def read_shaped_devices_csv():
-    shaped = OrderedDict()
+    shaped = {}
     if os.path.exists(SHAPED_DEVICES_CSV):
         with open(SHAPED_DEVICES_CSV, newline='') as f:
-            reader = csv.DictReader(f)
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if not header or "Device Name" not in header:
+                return shaped
+            name_idx = header.index("Device Name")
             for row in reader:
-                row["_last_seen"] = 0
-                shaped[row["Device Name"]] = row
+                if not row:
+                    continue
+                if len(row) < len(header):
+                    row += [''] * (len(header) - len(row))
+                entry = dict(zip(header, row))
+                entry["_last_seen"] = 0
+                shaped[row[name_idx]] = entry
     return shaped
 
+_last_csv_hash = None
+
 def write_shaped_devices_csv(data):
-    with open(SHAPED_DEVICES_CSV, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
-        writer.writeheader()
-        for row in data.values():
-            clean_row = {k: v for k, v in row.items() if k in FIELDNAMES}
-            writer.writerow(clean_row)
+    global _last_csv_hash
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(FIELDNAMES)
+    writer.writerows([row.get(k, '') for k in FIELDNAMES] for row in data.values())
+    payload = buf.getvalue()
+    digest = hashlib.blake2b(payload.encode(), digest_size=16).digest()
+    if digest == _last_csv_hash:
+        logger.debug("ShapedDevices.csv content unchanged; skipping write.")
+        return False
+    tmp = SHAPED_DEVICES_CSV + '.tmp'
+    with open(tmp, 'w', newline='') as f:
+        f.write(payload)
+    os.replace(tmp, SHAPED_DEVICES_CSV)
+    _last_csv_hash = digest
+    return True
 
 def wipe_shaped_devices_csv():
+    global _last_csv_hash
     with open(SHAPED_DEVICES_CSV, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
-        writer.writeheader()
+        csv.writer(f).writerow(FIELDNAMES)
+    _last_csv_hash = None
+
+_API_POOL = {}
+_api_pool_lock = threading.Lock()
 
 def connect_to_router(router):
-    try:
-        pool = routeros_api.RouterOsApiPool(
-            router['address'],
-            username=router['username'],
-            password=router['password'],
-            port=router.get('port', 8728),
-            plaintext_login=True,
-        )
-        return pool.get_api(), pool
-    except Exception as e:
-        logger.error(f"Failed to connect to router {router['name']}: {e}")
-        return None, None
+    key = router['address']
+    with _api_pool_lock:
+        cached = _API_POOL.get(key)
+    if cached:
+        pool, api = cached
+        try:
+            api.get_resource('/system/identity').get()
+            return api, pool
+        except Exception:
+            logger.warning(f"Cached connection to router {router['name']} is stale, reconnecting")
+            drop_cached_connection(router)
+
+    for attempt in range(CONNECT_ATTEMPTS):
+        try:
+            pool = routeros_api.RouterOsApiPool(
+                router['address'],
+                username=router['username'],
+                password=router['password'],
+                port=router.get('port', 8728),
+                plaintext_login=True,
+            )
+            api = pool.get_api()
+            with _api_pool_lock:
+                _API_POOL[key] = (pool, api)
+            return api, pool
+        except Exception as e:
+            logger.error(f"Failed to connect to router {router['name']} (attempt {attempt + 1}/{CONNECT_ATTEMPTS}): {e}")
+            if attempt < CONNECT_ATTEMPTS - 1:
+                time.sleep(2 ** attempt)
+    return None, None
+
+def drop_cached_connection(router):
+    with _api_pool_lock:
+        cached = _API_POOL.pop(router['address'], None)
+    if cached:
+        try:
+            cached[0].disconnect()
+        except:
+            pass
 
 def get_global_parent_manual_state(config):
     return any(router.get("parent_manual", False) for router in config.get("routers", []))
@@ -100,6 +184,7 @@ def check_and_wipe_on_state_change(current_state):
     else:
         logger.debug("Parent manual mode unchanged — keeping existing shaped data.")
 
+@lru_cache(maxsize=4096)
 def parse_rate_limit(rate_limit):
     if not rate_limit or rate_limit == '0/0':
         return '0', '0'
@@ -110,9 +195,23 @@ def parse_rate_limit(rate_limit):
     except:
         return '0', '0'
 
+_UNIT_MULT = {'k': 0.001, 'K': 0.001, 'm': 1.0, 'M': 1.0, 'g': 1000.0, 'G': 1000.0}
+
+@lru_cache(maxsize=512)
 def convert_to_mbps(value):
+    if not value:
+        return '0'
+    s = value.strip()
+    mult = _UNIT_MULT.get(s[-1:])
+    try:
+        if mult is not None:
+            return str(round(float(s[:-1]) * mult, 2))
+        return str(round(float(s), 2))
+    except ValueError:
+        pass
+    # Fallback for malformed values the fast path can't handle
     try:
-        match = re.match(r'(\d+(?:\.\d+)?)([kmgKMG])?', value)
+        match = _RATE_RE.match(s)
         if not match:
             return '0'
         number, unit = match.groups()
@@ -120,33 +219,70 @@ def convert_to_mbps(value):
         unit = unit.lower() if unit else ''
         if unit == 'k':
             return str(round(number / 1000, 2))
-        elif unit == 'm':
-            return str(round(number, 2))
         elif unit == 'g':
             return str(round(number * 1000, 2))
         return str(round(number, 2))
     except:
         return '0'
 
+def _safe_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+@lru_cache(maxsize=4096)
 def calculate_max_rates(rx, tx):
-    return str(max(int(float(rx) * MAX_RATE_PERCENTAGE), 2)), str(max(int(float(tx) * MAX_RATE_PERCENTAGE), 2))
+    return str(max(int(_safe_float(rx) * MAX_RATE_PERCENTAGE), 2)), str(max(int(_safe_float(tx) * MAX_RATE_PERCENTAGE), 2))
 
+@lru_cache(maxsize=4096)
 def calculate_min_rates(rx_max, tx_max):
-    return str(max(int(float(rx_max) * MIN_RATE_PERCENTAGE), 2)), str(max(int(float(tx_max) * MIN_RATE_PERCENTAGE), 2))
-
-def get_profile_rate_limits(api, profile_name):
+    return str(max(int(_safe_float(rx_max) * MIN_RATE_PERCENTAGE), 2)), str(max(int(_safe_float(tx_max) * MIN_RATE_PERCENTAGE), 2))
+
+_resource_cache = {}
+_resource_cache_lock = threading.Lock()
+
+def clear_resource_cache():
+    with _resource_cache_lock:
+        _resource_cache.clear()
+
+def get_resource_data(api, router, path):
+    key = (router['address'], path)
+    with _resource_cache_lock:
+        if key in _resource_cache:
+            logger.debug("Reusing cached %s data for %s", path, router['address'])
+            return _resource_cache[key]
+    data = api.get_resource(path).get()
+    with _resource_cache_lock:
+        _resource_cache[key] = data
+    return data
+
+def rates_for_limit(rate_limit):
+    rx, tx = parse_rate_limit(rate_limit)
+    rx_max, tx_max = calculate_max_rates(rx, tx)
+    rx_min, tx_min = calculate_min_rates(rx_max, tx_max)
+    return rx_max, tx_max, rx_min, tx_min
+
+def fetch_profile_rate_limits(api, router):
     try:
-        profiles = api.get_resource('/ppp/profile').get(name=profile_name)
-        if profiles:
-            return profiles[0].get('rate-limit') or profiles[0].get('comment', '50M/50M')
+        profiles = get_resource_data(api, router, '/ppp/profile')
+        return {p['name']: (p.get('rate-limit') or p.get('comment', '50M/50M'))
+                for p in profiles if 'name' in p}
     except:
-        pass
-    return '50M/50M'
+        return {}
+
+_static_cache = {"mtime": None, "result": None}
+
+def process_static_devices(existing=None):
+    mtime = os.stat(STATIC_JSON).st_mtime_ns if os.path.exists(STATIC_JSON) else None
+    if mtime is not None and mtime == _static_cache["mtime"]:
+        logger.debug("Static device file unchanged; reusing parsed devices.")
+        return _static_cache["result"]
 
-def process_static_devices():
     static_data = read_json_data(STATIC_JSON)
     static_devices = static_data.get("StaticDevices", [])
-    shaped = OrderedDict()
+    existing = existing if existing is not None else {}
+    shaped = {}
     reserved_ips = set()
 
     for device in static_devices:
@@ -154,10 +290,12 @@ def process_static_devices():
         ip = device.get("IPv4", "")
         key = devname.replace(" ", "-").upper()
         reserved_ips.add(ip)
-        logger.info(f"Adding Static device {devname} with IP {ip}")
+        logger.debug("Adding Static device %s with IP %s", devname, ip)
+        # The CSV keys rows by the raw Device Name, not the normalized key
+        old = existing.get(key) or existing.get(devname) or {}
         shaped[key] = {
-            "Circuit ID": generate_short_id(),
-            "Device ID": generate_short_id(),
+            "Circuit ID": old.get("Circuit ID") or generate_short_id(),
+            "Device ID": old.get("Device ID") or generate_short_id(),
             "Circuit Name": device.get("Circuit Name", devname),
             "Device Name": devname,
             "MAC": device.get("MAC", ""),
@@ -170,119 +308,192 @@ def process_static_devices():
             "Download Max Mbps": device.get("Download Max Mbps", "100"),
             "Upload Max Mbps": device.get("Upload Max Mbps", "100")
         }
+    _static_cache["mtime"] = mtime
+    _static_cache["result"] = (shaped, reserved_ips)
     return shaped, reserved_ips
 
-def extract_parents_from_network(network_dict, prefix):
-    return [name for name in network_dict if name.upper().startswith(prefix.upper())]
+_parent_cache = {}
 
-def process_pppoe_users(api, router, shaped_data, reserved_ips, parent_nodes, rotate_index=0):
-    if not router.get("pppoe", {}).get("enabled"):
-        return {}, rotate_index
+def extract_parents_from_network(network_dict, prefix):
+    cached = _parent_cache.get(prefix)
+    if cached is not None and cached[0] is network_dict:
+        return cached[1]
+    prefix_upper = prefix.upper()
+    parents = [name for name in network_dict if name.upper().startswith(prefix_upper)]
+    _parent_cache[prefix] = (network_dict, parents)
+    return parents
+
+def next_parent_node(parent_nodes):
+    with rotate_lock:
+        node = parent_nodes[rotate_state["index"] % len(parent_nodes)]
+        rotate_state["index"] += 1
+    return node
+
+def process_pppoe_users(api, router, shaped_data, reserved_ips, parent_nodes, ppp_ip_index, now):
+    pppoe_cfg = router.get("pppoe") or {}
+    if not pppoe_cfg.get("enabled"):
+        return {}
 
     users = {}
     name = router["name"]
-    secrets = {s["name"]: s for s in api.get_resource("/ppp/secret").get() if "name" in s}
-    active = {a["name"]: a for a in api.get_resource("/ppp/active").get() if "name" in a}
-    existing_ips = {v["IPv4"]: k for k, v in shaped_data.items() if v["Comment"] == "PPP"}
+    ppp_parent = f"PPP-{name}"
+    secrets = {s["name"]: s for s in get_resource_data(api, router, "/ppp/secret") if "name" in s}
+    active = {a["name"]: a for a in get_resource_data(api, router, "/ppp/active") if "name" in a}
+    profile_limits = fetch_profile_rate_limits(api, router)
+    profile_rates = {}
 
-    for uname, secret in secrets.items():
-        if uname in active and "address" in active[uname]:
-            addr = active[uname]["address"]
+    for uname, act in active.items():
+        secret = secrets.get(uname)
+        if secret is not None and "address" in act:
+            addr = act["address"]
 
             if addr in reserved_ips:
-                logger.info(f"Skipping PPPoE user {uname} — IP {addr} is reserved for static device.")
+                logger.debug("Skipping PPPoE user %s — IP %s is reserved for static device.", uname, addr)
                 continue
 
             if uname in shaped_data and shaped_data[uname]["IPv4"] == addr:
-                shaped_data[uname]["_last_seen"] = time.time()
-                logger.debug(f"Skipping PPPoE user {uname} — already up to date.")
+                shaped_data[uname]["_last_seen"] = now
+                logger.debug("Skipping PPPoE user %s — already up to date.", uname)
                 continue
 
             if uname in shaped_data and shaped_data[uname]["IPv4"] != addr:
-                logger.warning(f"{uname} IP changed from {shaped_data[uname]['IPv4']} to {addr}, removing old entry")
-                shaped_data.pop(uname, None)
-
-            if addr in existing_ips:
-                old_user = existing_ips[addr]
-                if old_user != uname:
-                    logger.warning(f"IP conflict: {addr} reassigned from {old_user} to {uname}")
+                logger.warning("%s IP changed from %s to %s, removing old entry", uname, shaped_data[uname]['IPv4'], addr)
+                with shaped_lock:
+                    old_row = shaped_data.pop(uname, None)
+                    if old_row and ppp_ip_index.get(old_row.get("IPv4")) == uname:
+                        ppp_ip_index.pop(old_row["IPv4"], None)
+
+            old_user = ppp_ip_index.get(addr)
+            if old_user is not None and old_user != uname:
+                logger.warning("IP conflict: %s reassigned from %s to %s", addr, old_user, uname)
+                with shaped_lock:
                     shaped_data.pop(old_user, None)
 
             profile = secret.get("profile", "default")
-            rate_limit = get_profile_rate_limits(api, profile)
-            rx, tx = parse_rate_limit(rate_limit)
-            rx_max, tx_max = calculate_max_rates(rx, tx)
-            rx_min, tx_min = calculate_min_rates(rx_max, tx_max)
-
-            parent_node = parent_nodes[rotate_index % len(parent_nodes)] if parent_nodes else f"PPP-{name}"
-            rotate_index += 1
-
-            logger.info(f"Adding PPPoE user {uname} with IP {addr} -> Parent Node: {parent_node}")
-            users[uname] = {
-                "Circuit ID": generate_short_id(),
-                "Device ID": generate_short_id(),
-                "Circuit Name": uname,
-                "Device Name": uname,
-                "MAC": secret.get("caller-id", ""),
-                "IPv4": addr,
-                "IPv6": "",
-                "Parent Node": parent_node,
-                "Comment": "PPP",
-                "Download Max Mbps": rx_max,
-                "Upload Max Mbps": tx_max,
-                "Download Min Mbps": rx_min,
-                "Upload Min Mbps": tx_min,
-                "_last_seen": time.time()
-            }
-    return users, rotate_index
-
-def process_hotspot_users(api, router, shaped_data, reserved_ips):
-    if not router.get("hotspot", {}).get("enabled"):
+            rates = profile_rates.get(profile)
+            if rates is None:
+                rates = rates_for_limit(profile_limits.get(profile) or '50M/50M')
+                profile_rates[profile] = rates
+            rx_max, tx_max, rx_min, tx_min = rates
+
+            parent_node = next_parent_node(parent_nodes) if parent_nodes else ppp_parent
+
+            logger.debug("Adding PPPoE user %s with IP %s -> Parent Node: %s", uname, addr, parent_node)
+            entry = _ROW_TEMPLATE.copy()
+            entry["Circuit ID"] = generate_short_id()
+            entry["Device ID"] = generate_short_id()
+            entry["Circuit Name"] = uname
+            entry["Device Name"] = uname
+            entry["MAC"] = secret.get("caller-id", "")
+            entry["IPv4"] = addr
+            entry["Parent Node"] = parent_node
+            entry["Comment"] = "PPP"
+            entry["Download Max Mbps"] = rx_max
+            entry["Upload Max Mbps"] = tx_max
+            entry["Download Min Mbps"] = rx_min
+            entry["Upload Min Mbps"] = tx_min
+            entry["_last_seen"] = now
+            users[uname] = entry
+            ppp_ip_index[addr] = uname
+    if users:
+        logger.info("Router %s: %d new/changed PPPoE users", name, len(users))
+    return users
+
+def process_hotspot_users(api, router, shaped_data, reserved_ips, now):
+    hotspot_cfg = router.get("hotspot") or {}
+    if not hotspot_cfg.get("enabled"):
         return {}
 
     users = {}
     name = router["name"]
-    dl = str(router.get("hotspot", {}).get("download_limit_mbps", 10))
-    ul = str(router.get("hotspot", {}).get("upload_limit_mbps", 10))
-    for user in api.get_resource("/ip/hotspot/active").get():
+    hs_parent = f"HS-{name}"
+    dl = str(hotspot_cfg.get("download_limit_mbps", 10))
+    ul = str(hotspot_cfg.get("upload_limit_mbps", 10))
+    dl_min = str(int(float(dl) * MIN_RATE_PERCENTAGE))
+    ul_min = str(int(float(ul) * MIN_RATE_PERCENTAGE))
+    for user in get_resource_data(api, router, "/ip/hotspot/active"):
         uname = user.get("user") or user.get("mac-address") or user.get("address")
         ip = user.get("address")
         if not uname or not ip:
             continue
 
         if ip in reserved_ips:
-            logger.info(f"Skipping Hotspot user {uname} — IP {ip} is reserved for static device.")
+            logger.debug("Skipping Hotspot user %s — IP %s is reserved for static device.", uname, ip)
             continue
 
         code = f"HS-{uname.replace(':', '').replace('.', '')}"
         if code in shaped_data and shaped_data[code]["IPv4"] == ip:
-            shaped_data[code]["_last_seen"] = time.time()
-            logger.debug(f"Skipping Hotspot user {code} — already up to date.")
+            shaped_data[code]["_last_seen"] = now
+            logger.debug("Skipping Hotspot user %s — already up to date.", code)
             continue
 
-        logger.info(f"Adding Hotspot user {uname} with IP {ip}")
-        users[code] = {
-            "Circuit ID": generate_short_id(),
-            "Device ID": generate_short_id(),
-            "Circuit Name": code,
-            "Device Name": code,
-            "MAC": user.get("mac-address", ""),
-            "IPv4": ip,
-            "IPv6": "",
-            "Parent Node": f"HS-{name}",
-            "Comment": "Hotspot",
-            "Download Max Mbps": dl,
-            "Upload Max Mbps": ul,
-            "Download Min Mbps": str(int(float(dl) * MIN_RATE_PERCENTAGE)),
-            "Upload Min Mbps": str(int(float(ul) * MIN_RATE_PERCENTAGE)),
-            "_last_seen": time.time()
-        }
+        logger.debug("Adding Hotspot user %s with IP %s", uname, ip)
+        entry = _ROW_TEMPLATE.copy()
+        entry["Circuit ID"] = generate_short_id()
+        entry["Device ID"] = generate_short_id()
+        entry["Circuit Name"] = code
+        entry["Device Name"] = code
+        entry["MAC"] = user.get("mac-address", "")
+        entry["IPv4"] = ip
+        entry["Parent Node"] = hs_parent
+        entry["Comment"] = "Hotspot"
+        entry["Download Max Mbps"] = dl
+        entry["Upload Max Mbps"] = ul
+        entry["Download Min Mbps"] = dl_min
+        entry["Upload Min Mbps"] = ul_min
+        entry["_last_seen"] = now
+        users[code] = entry
+    if users:
+        logger.info("Router %s: %d new/changed Hotspot users", name, len(users))
+    return users
+
+
+_libreqos_proc = None
+
+def launch_libreqos_update():
+    global _libreqos_proc
+    if _libreqos_proc is not None:
+        if _libreqos_proc.poll() is None:
+            logger.info("Previous LibreQoS update still running; waiting for it to finish")
+            _libreqos_proc.wait()
+        if _libreqos_proc.returncode != 0:
+            logger.error("LibreQoS update exited with code %s", _libreqos_proc.returncode)
+    _libreqos_proc = subprocess.Popen(["sudo", "/opt/libreqos/src/LibreQoS.py", "--updateonly"])
+
+def merge_updates(shaped_data, new_entries):
+    changed = False
+    for key, row in new_entries.items():
+        old = shaped_data.get(key)
+        if old is not None and all(old.get(k) == v for k, v in row.items() if k != "_last_seen"):
+            if "_last_seen" in row:
+                old["_last_seen"] = row["_last_seen"]
+            continue
+        shaped_data[key] = row
+        changed = True
+    return changed
+
+def scan_router(router, shaped_data, reserved_ips, all_parent_nodes, ppp_ip_index, now):
+    api, pool = connect_to_router(router)
+    if not api:
+        return {}
+
+    users = {}
+    try:
+        parent_nodes = all_parent_nodes if router.get("parent_manual", False) else []
+        if router.get("parent_manual", False) and not parent_nodes:
+            logger.warning(f"Router {router['name']} has parent_manual=true but no PPPOE- nodes found")
+        users.update(process_pppoe_users(api, router, shaped_data, reserved_ips, parent_nodes, ppp_ip_index, now))
+        users.update(process_hotspot_users(api, router, shaped_data, reserved_ips, now))
+    except Exception:
+        drop_cached_connection(router)
+        raise
     return users
 
 
 def process_cycle():
     global shaped_data, static_data, reserved_ips, config, routers, network_data
 
+    clear_resource_cache()
     config = read_json_data(CONFIG_JSON)
     routers = config.get("routers", [])
     scan_interval = config.get("scan_interval", DEFAULT_SCAN_INTERVAL)
@@ -290,41 +501,48 @@ def process_cycle():
     check_and_wipe_on_state_change(parent_manual_state)
 
     shaped_data = read_shaped_devices_csv()
-    static_data, reserved_ips = process_static_devices()
-    shaped_data.update(static_data)
+    static_data, reserved_ips = process_static_devices(shaped_data)
+    any_updates = merge_updates(shaped_data, static_data)
 
     network_data = read_json_data(NETWORK_JSON)
     all_parent_nodes = extract_parents_from_network(network_data, "PPPOE-")
-    rotate_index = 0
-
-    for router in routers:
-        api, pool = connect_to_router(router)
-        if not api:
-            continue
-
-        try:
-            parent_nodes = all_parent_nodes if router.get("parent_manual", False) else []
-            if router.get("parent_manual", False) and not parent_nodes:
-                logger.warning(f"Router {router['name']} has parent_manual=true but no PPPOE- nodes found")
-            pppoe_data, rotate_index = process_pppoe_users(api, router, shaped_data, reserved_ips, parent_nodes, rotate_index)
-            shaped_data.update(pppoe_data)
-            shaped_data.update(process_hotspot_users(api, router, shaped_data, reserved_ips))
-        finally:
-            try:
-                pool.disconnect()
-            except:
-                pass
-
-    # Prune inactive dynamic users
+    rotate_state["index"] = 0
     now = time.time()
-    shaped_data = {k: v for k, v in shaped_data.items()
-                   if v.get("Comment") not in ["PPP", "Hotspot"] or (now - float(v.get("_last_seen", now))) <= 1200}
+    ppp_ip_index = {v["IPv4"]: k for k, v in shaped_data.items() if v.get("Comment") == "PPP"}
+
+    if routers:
+        with ThreadPoolExecutor(max_workers=min(MAX_SCAN_WORKERS, len(routers))) as executor:
+            futures = {executor.submit(scan_router, router, shaped_data, reserved_ips, all_parent_nodes, ppp_ip_index, now): router
+                       for router in routers}
+            for future in as_completed(futures):
+                router = futures[future]
+                try:
+                    if merge_updates(shaped_data, future.result()):
+                        any_updates = True
+                except Exception as e:
+                    logger.error(f"Error scanning router {router['name']}: {e}")
 
-    write_shaped_devices_csv(shaped_data)
-    subprocess.run(["sudo", "/opt/libreqos/src/LibreQoS.py", "--updateonly"], check=True)
+    # Prune inactive dynamic users
+    stale = {k for k, v in shaped_data.items()
+             if v.get("Comment") in ("PPP", "Hotspot") and (now - float(v.get("_last_seen", now))) > 1200}
+    if stale:
+        for code in stale:
+            del shaped_data[code]
+        any_updates = True
+        logger.info("Removed %d inactive users", len(stale))
+
+    if any_updates:
+        if write_shaped_devices_csv(shaped_data):
+            launch_libreqos_update()
+        else:
+            logger.debug("CSV output identical; skipping LibreQoS reload.")
+    else:
+        logger.debug("No changes detected; skipping CSV write and LibreQoS reload.")
 
     # RAM check and restart
-    ram_mb = psutil.Process(os.getpid()).memory_info().rss / 1024 / 1024
+    with open('/proc/self/statm') as f:
+        rss_pages = int(f.read().split()[1])
+    ram_mb = rss_pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
     logger.info(f"RAM usage: {ram_mb:.2f} MB")
     if ram_mb > args.max_ram_mb:
         logger.warning(f"RAM exceeded {args.max_ram_mb} MB. Restarting script...")
@@ -333,9 +551,11 @@ def process_cycle():
 
     del shaped_data, static_data, reserved_ips, config, routers, network_data
     gc.collect()
+    return scan_interval
 
 def main():
     global cycle_count
+    next_tick = time.monotonic()
     while True:
         if args.max_cycles and cycle_count >= args.max_cycles:
             logger.info("Reached max cycles limit. Exiting.")
@@ -344,12 +564,15 @@ def main():
             logger.info("Reached max runtime limit. Exiting.")
             break
         try:
-            process_cycle()
+            scan_interval = process_cycle()
             cycle_count += 1
-            logger.info(f"Cycle complete. Sleeping {DEFAULT_SCAN_INTERVAL} seconds...")
-            time.sleep(DEFAULT_SCAN_INTERVAL)
+            next_tick += scan_interval
+            delay = max(0, next_tick - time.monotonic())
+            logger.info(f"Cycle complete. Next scan in {delay:.1f} seconds...")
+            time.sleep(delay)
         except Exception as e:
             logger.error(f"Error occurred: {e}")
+            next_tick = time.monotonic() + ERROR_RETRY_INTERVAL
             time.sleep(ERROR_RETRY_INTERVAL)
 
 if __name__ == "__main__":